@@ -5,102 +5,544 @@ Stitch Witch OCR Service - Production Version
 import os
 import json
 import base64
+import hashlib
 import io
-from flask import Flask, request, jsonify
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from flask import Flask, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+import orjson
+from PIL import Image, ImageOps, UnidentifiedImageError
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.cloud import firestore
 import logging
-import PyPDF2
+import pdf_text
 # from iterative_processor import create_pattern_processor
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+# Per-step detail is logged at DEBUG; set LOG_LEVEL=DEBUG to see it
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
 
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson for request parsing and jsonify"""
+    
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # orjson already produces bytes; skip the str round-trip in the base class
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
 # Initialize Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app, origins=["*"], 
      allow_headers=["Content-Type", "Authorization"],
      methods=["GET", "POST", "OPTIONS"])
 
-# Initialize Firestore
-db = firestore.Client()
+# Size limits, checked before any body is parsed or base64-decoded.
+# Cloud Run caps request bodies at 32 MiB anyway.
+MAX_REQUEST_BYTES = int(os.environ.get('MAX_REQUEST_BYTES', 32 * 1024 * 1024))
+MAX_NAME_LENGTH = 200
+MAX_PATTERN_TEXT_LENGTH = 100000
+MIN_PATTERN_TEXT_LENGTH = 50
+PATTERN_TEXT_TOO_SHORT_ERROR = "Pattern text is too short. Please provide more detailed pattern instructions."
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+
+# Firestore client, created on first use (see get_db)
+_db = None
+_db_lock = threading.Lock()
+
+# Background pool for Firestore writes that don't need to block the response
+firestore_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='firestore-write')
+
+# PDF text extraction is CPU-bound, so large PDFs are split across a
+# process pool (created on first use) instead of one serialized thread
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', os.cpu_count() or 1))
+# (max pages, workers) by PDF size. Every worker re-opens the whole document,
+# so small PDFs are split fewer ways; 1 worker means extract in-process.
+PDF_PARALLELISM_RULES = (
+    (7, 1),
+    (50, 2),
+    (200, 4),
+)
+_pdf_executor = None
+_pdf_executor_lock = threading.Lock()
+
+# PDFs averaging fewer extracted characters per page than this are treated
+# as scans and OCR'd from rendered pages (scale 2 = 144 dpi)
+SCANNED_PDF_MIN_CHARS_PER_PAGE = 50
+SCANNED_PDF_RENDER_SCALE = 2
+# Only this many leading pages of a scan are rendered and billed through Vision
+SCANNED_PDF_MAX_PAGES = int(os.environ.get('SCANNED_PDF_MAX_PAGES', 30))
+
+# Per-process caps on in-flight upstream calls; excess threads queue here
+# instead of bursting past API quotas and burning retries on 429s
+vision_semaphore = threading.BoundedSemaphore(int(os.environ.get('VISION_MAX_CONCURRENCY', 6)))
+gemini_semaphore = threading.BoundedSemaphore(int(os.environ.get('GEMINI_MAX_CONCURRENCY', 4)))
+
+# Phone photos are often 12 MP; OCR quality holds at a 2000 px long edge,
+# and smaller images make for faster, cheaper Vision calls
+VISION_MAX_DIMENSION = 2000
+VISION_RESIZE_MIN_BYTES = 1024 * 1024
+# Vision accepts at most 16 images and a 10 MB JSON body per images:annotate
+# request; batches close at whichever limit comes first, with headroom
+VISION_BATCH_SIZE = 16
+VISION_BATCH_MAX_BYTES = 9 * 1024 * 1024
+
+# Shared HTTP session so Vision/Gemini calls reuse pooled keep-alive
+# connections instead of paying a TCP+TLS handshake per request.
+# Transient 429/5xx responses are retried with backoff (honoring Retry-After);
+# once retries run out the last response is returned for normal error handling.
+# Read timeouts are not retried: a timed-out Gemini POST may still be generating
+# (and billing), and resending it would hold the request for minutes.
+HTTP_RETRY_AFTER_MAX_SECONDS = 10
+
+class CappedRetry(Retry):
+    """Retry whose Retry-After waits are capped, since callers hold a semaphore while sleeping"""
+    
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, HTTP_RETRY_AFTER_MAX_SECONDS)
+
+http_retry = CappedRetry(
+    total=3,
+    read=False,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=['HEAD', 'GET', 'POST'],
+    raise_on_status=False
+)
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=20, max_retries=http_retry))
 
 # Get API keys from environment
 VISION_API_KEY = os.environ.get('VISION_API_KEY')
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 
+# Exact-match cache of Gemini responses, keyed by SHA-256 of the prompt
+GEMINI_CACHE_COLLECTION = 'gemini_cache'
+GEMINI_CACHE_TTL = timedelta(hours=24)
+
+# Decodes the first JSON object in a reply and ignores whatever follows it
+JSON_OBJECT_DECODER = json.JSONDecoder()
+
+# Abort a streamed Gemini reply that hasn't opened a JSON object by this point
+GEMINI_JSON_PREFIX_LIMIT = 500
+
+# Static LogicGuide instructions. Kept byte-identical across requests and placed
+# ahead of all per-pattern data so Gemini's prefix cache can reuse it.
+LOGIC_GUIDE_PROMPT = """You are an expert knitting pattern translator. Your task is to convert a condensed, human-readable knitting pattern into a fully enumerated, step-by-step JSON document following our precise Firestore schema.
+
+CORE PHILOSOPHY: Transform ambiguity into certainty. Eliminate all loops, repeats, and variables, producing a complete, explicit list of actions from cast on to bind off.
+
+TARGET SCHEMA:
+{
+  "metadata": {
+    "name": "<pattern name given below>",
+    "author": "<author name given below>",
+    "craft": "knitting",
+    "maxSteps": 280
+  },
+  "glossary": {
+    "k": { "name": "Knit", "description": "A standard knit stitch.", "stitchesUsed": 1, "stitchesCreated": 1 },
+    "kfb": { "name": "Knit Front and Back", "description": "A one-stitch increase.", "stitchesUsed": 1, "stitchesCreated": 2 },
+    "k2tog": { "name": "Knit 2 Together", "description": "A one-stitch decrease.", "stitchesUsed": 2, "stitchesCreated": 1 }
+  },
+  "steps": [
+    {
+      "step": 1,
+      "startingStitchCount": 3,
+      "endingStitchCount": 4,
+      "instruction": "k1, kfb, k1",
+      "section": "setup",
+      "side": "RS",
+      "type": "regular"
+    }
+  ]
+}
+
+CRITICAL REQUIREMENTS:
+
+1. GLOSSARY CREATION: Build a complete glossary for EVERY stitch abbreviation used in the pattern. Each entry must have:
+   - name: Full name of the stitch
+   - description: Clear explanation of the technique
+   - stitchesUsed: How many stitches are consumed from left needle
+   - stitchesCreated: How many stitches are placed on right needle
+
+   Net change = stitchesCreated - stitchesUsed
+
+2. STITCH COUNT CALCULATION: Every step MUST have accurate startingStitchCount and endingStitchCount. The endingStitchCount of one step becomes the startingStitchCount of the next.
+
+3. EXPAND ALL REPEATS:
+   - "Repeat Rows 3 and 4 five more times" → Generate 10 individual steps with consecutive numbering
+   - "(yo, ssk) 6 times" → "yo, ssk, yo, ssk, yo, ssk, yo, ssk, yo, ssk, yo, ssk"
+   - Recalculate variables like "k to end" for each expanded row
+
+4. RESOLVE VARIABLES:
+   - "k to end" depends on current stitch count and preceding stitches in the row
+   - Example: Row with 10 stitches starting "k2, yo," then "k to end" = "k7" (10 - 2 knit - 1 yo stitch created)
+   - Always provide the fully resolved instruction
+
+5. SEQUENTIAL PROCESSING:
+   - Initialize: currentStepNumber = 1, currentStitchCount from cast on
+   - For each row: calculate starting count, resolve variables, expand repeats, calculate ending count
+   - Update state: currentStitchCount = endingStitchCount, increment step number
+   - Alternate side: RS → WS → RS
+
+INSTRUCTIONS:
+1. First, identify the cast on instruction to establish initial stitch count
+2. Scan the entire pattern to build the complete glossary
+3. Process each row sequentially, expanding all repeats
+4. Calculate accurate stitch counts for every step
+5. Resolve all variable instructions to specific numbers
+6. Use the pattern name and author exactly as given for metadata.name and metadata.author
+7. Return ONLY the JSON object, no extra text or formatting
+
+Everything after the ---DYNAMIC--- marker is the pattern to convert.
+"""
+
+# Per-pattern suffix appended after the static prefix
+PATTERN_PROMPT_TEMPLATE = "\n---DYNAMIC---\nName: {pattern_name}\nAuthor: {author_name}\nPattern Text:\n{pattern_text}\n"
+
+# Identifies the prompt revision in cache entries and /health
+PROMPT_VERSION = hashlib.sha256((LOGIC_GUIDE_PROMPT + PATTERN_PROMPT_TEMPLATE).encode('utf-8')).hexdigest()[:12]
+
+@app.before_request
+def reject_oversized_requests():
+    """Refuse bodies over MAX_REQUEST_BYTES before the handler reads them"""
+    if request.content_length is not None and request.content_length > MAX_REQUEST_BYTES:
+        return jsonify({
+            'success': False,
+            'error': f'Request body exceeds {MAX_REQUEST_BYTES} bytes'
+        }), 413
+
+def find_overlong_field(data: dict, limits: dict):
+    """Return the first field in data longer than its limit, if any"""
+    for field, max_length in limits.items():
+        value = data.get(field)
+        if isinstance(value, str) and len(value) > max_length:
+            return field
+    return None
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({
         'status': 'healthy',
         'service': 'stitch-witch-ocr',
-        'version': '3.0.0-production'
+        'version': '3.0.0-production',
+        'promptVersion': PROMPT_VERSION
     })
 
-def extract_text_from_pdf(base64_data: str) -> str:
-    """Extract text from PDF using PyPDF2"""
-    logger.info("Processing PDF file")
+def get_db() -> firestore.Client:
+    """Create the Firestore client on first use"""
+    # Deferred so PDF pool children, which re-import this module when it is
+    # run as `python main.py`, never open a Firestore channel
+    global _db
+    with _db_lock:
+        if _db is None:
+            _db = firestore.Client()
+        return _db
+
+def get_pdf_executor() -> ProcessPoolExecutor:
+    """Create the PDF process pool on first use"""
+    global _pdf_executor
+    with _pdf_executor_lock:
+        if _pdf_executor is None:
+            # spawn, not fork: forking a threaded worker with live gRPC channels is unsafe
+            _pdf_executor = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _pdf_executor
+
+def discard_pdf_executor(executor: ProcessPoolExecutor) -> None:
+    """Forget a broken PDF process pool so get_pdf_executor builds a new one"""
+    global _pdf_executor
+    with _pdf_executor_lock:
+        # Another thread may already have replaced it
+        if _pdf_executor is executor:
+            _pdf_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def pdf_workers_for(page_count: int) -> int:
+    """Pick how many processes to split a PDF across from PDF_PARALLELISM_RULES"""
+    for max_pages, workers in PDF_PARALLELISM_RULES:
+        if page_count <= max_pages:
+            return min(workers, PDF_WORKERS)
+    return PDF_WORKERS
+
+def extract_pdf_pages_in_parallel(pdf_bytes: bytes, page_count: int, workers: int) -> list:
+    """Extract page text across the process pool, one contiguous page range per worker"""
+    chunk_size = -(-page_count // workers)
+    ranges = [(start, min(start + chunk_size, page_count)) for start in range(0, page_count, chunk_size)]
+    
+    executor = get_pdf_executor()
     try:
-        pdf_bytes = base64.b64decode(base64_data)
-        pdf_file = io.BytesIO(pdf_bytes)
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-        
-        extracted_text = ""
-        for page_num, page in enumerate(pdf_reader.pages):
-            page_text = page.extract_text()
-            extracted_text += f"Page {page_num + 1}:\n{page_text}\n\n"
+        futures = [executor.submit(pdf_text.extract_page_range, pdf_bytes, start, stop) for start, stop in ranges]
+        
+        # Futures are in page order, so concatenating results preserves it
+        page_texts = []
+        for future in futures:
+            page_texts.extend(future.result())
+        return page_texts
+    except BrokenProcessPool:
+        # A child died (OOM or a PDFium crash); drop the pool so the next
+        # request starts a fresh one, and finish this PDF in-process
+        logger.warning("PDF process pool broke; rebuilding it and extracting in-process")
+        discard_pdf_executor(executor)
+        return pdf_text.extract_page_range(pdf_bytes, 0, page_count)
+
+def extract_text_from_scanned_pdf(pdf_bytes: bytes, page_count: int) -> list:
+    """OCR the leading pages of an image-only PDF with batched Vision calls"""
+    ocr_page_count = min(page_count, SCANNED_PDF_MAX_PAGES)
+    if ocr_page_count < page_count:
+        logger.warning("Scanned PDF has %s pages; only the first %s are sent to Vision",
+                       page_count, ocr_page_count)
+    
+    page_images = pdf_text.render_page_range(pdf_bytes, 0, ocr_page_count, SCANNED_PDF_RENDER_SCALE, VISION_MAX_DIMENSION)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Rendered %s scanned pages for Vision: %s -> %s bytes",
+                     ocr_page_count, len(pdf_bytes), sum(len(image) for image in page_images))
+    return extract_text_from_images([base64.b64encode(image).decode('ascii') for image in page_images])
+
+def extract_text_from_pdf(pdf_data) -> str:
+    """Extract text from PDF using PDFium (accepts base64 str or raw bytes)"""
+    logger.debug("Processing PDF file")
+    try:
+        pdf_bytes = base64.b64decode(pdf_data) if isinstance(pdf_data, str) else pdf_data
+        page_count = pdf_text.count_pages(pdf_bytes)
         
-        logger.info(f"PDF processing complete: {len(extracted_text)} characters")
-        return extracted_text.strip()
+        workers = pdf_workers_for(page_count)
+        if workers > 1:
+            page_texts = extract_pdf_pages_in_parallel(pdf_bytes, page_count, workers)
+        else:
+            page_texts = pdf_text.extract_page_range(pdf_bytes, 0, page_count)
+        
+        if sum(len(page_text.strip()) for page_text in page_texts) < SCANNED_PDF_MIN_CHARS_PER_PAGE * page_count:
+            logger.info("PDF has no usable text layer, sending it to Vision")
+            try:
+                ocr_texts = extract_text_from_scanned_pdf(pdf_bytes, page_count)
+                # Pages past SCANNED_PDF_MAX_PAGES keep whatever text layer they had
+                page_texts = ocr_texts + page_texts[len(ocr_texts):]
+            except Exception as e:
+                # OCR is best-effort: on a render failure (files only PyPDF2 can
+                # read) or a Vision error, return the text layer we already have
+                logger.warning("Scanned PDF OCR failed, keeping extracted text: %s", e)
+        
+        extracted_text = "".join(
+            f"Page {page_num}:\n{page_text}\n\n" for page_num, page_text in enumerate(page_texts, 1)
+        ).strip()
+        
+        logger.info("PDF processing complete: %s characters", len(extracted_text))
+        return extracted_text
         
     except Exception as e:
-        logger.error(f"PDF processing failed: {str(e)}")
+        logger.error("PDF processing failed: %s", e)
         raise Exception(f"PDF processing error: {str(e)}")
 
-def extract_text_from_image(base64_data: str) -> str:
-    """Extract text from image using Vision API"""
-    logger.info("Processing image with Vision API")
+def _annotate_image_batch(base64_images: list) -> list:
+    """Run TEXT_DETECTION on one batch of images in a single Vision call"""
+    url = f"https://vision.googleapis.com/v1/images:annotate?key={VISION_API_KEY}"
+    
+    payload = {
+        "requests": [{
+            "image": {"content": base64_data},
+            "features": [{"type": "TEXT_DETECTION"}]
+        } for base64_data in base64_images]
+    }
+    
+    with vision_semaphore:
+        response = http_session.post(url, json=payload)
+    
+    if response.status_code != 200:
+        raise Exception(f"Vision API error: {response.text}")
+    
+    result = orjson.loads(response.content)
+    
+    texts = []
+    for image_result in result.get('responses', []):
+        if 'error' in image_result:
+            logger.warning("Vision API skipped an image: %s", image_result['error'].get('message'))
+        annotations = image_result.get('textAnnotations')
+        texts.append(annotations[0]['description'] if annotations else "")
+    return texts
+
+def batch_images_for_vision(base64_images: list) -> list:
+    """Group images into batches within Vision's per-request count and size limits"""
+    batches = []
+    batch, batch_bytes = [], 0
+    for base64_data in base64_images:
+        if batch and (len(batch) == VISION_BATCH_SIZE or
+                      batch_bytes + len(base64_data) > VISION_BATCH_MAX_BYTES):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(base64_data)
+        batch_bytes += len(base64_data)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def extract_text_from_images(base64_images: list) -> list:
+    """Extract text from several images, batching them into Vision API calls"""
+    logger.debug("Processing %s image(s) with Vision API", len(base64_images))
     try:
-        url = f"https://vision.googleapis.com/v1/images:annotate?key={VISION_API_KEY}"
-        
-        payload = {
-            "requests": [{
-                "image": {"content": base64_data},
-                "features": [{"type": "TEXT_DETECTION"}]
-            }]
-        }
-        
-        response = requests.post(url, json=payload)
-        
-        if response.status_code != 200:
-            raise Exception(f"Vision API error: {response.text}")
+        batches = batch_images_for_vision(base64_images)
         
-        result = response.json()
-        
-        if ('responses' in result and len(result['responses']) > 0 and
-            'textAnnotations' in result['responses'][0] and
-            len(result['responses'][0]['textAnnotations']) > 0):
-            
-            extracted_text = result['responses'][0]['textAnnotations'][0]['description']
-            logger.info(f"Vision API processing complete: {len(extracted_text)} characters")
-            return extracted_text
+        if not batches:
+            return []
+        if len(batches) == 1:
+            batch_texts = [_annotate_image_batch(batches[0])]
         else:
-            return ""
+            # vision_semaphore still caps how many of these run at once
+            with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+                batch_texts = list(executor.map(_annotate_image_batch, batches))
+        
+        texts = [text for batch in batch_texts for text in batch]
+        logger.info("Vision API processing complete: %s characters",
+                    sum(len(text) for text in texts))
+        return texts
             
     except Exception as e:
-        logger.error(f"Vision API processing failed: {str(e)}")
+        logger.error("Vision API processing failed: %s", e)
         raise Exception(f"Vision API error: {str(e)}")
 
+def extract_text_from_image(base64_data: str) -> str:
+    """Extract text from image using Vision API"""
+    texts = extract_text_from_images([base64_data])
+    return texts[0] if texts else ""
+
+def _log_background_save(future, pattern_id: str) -> None:
+    error = future.exception()
+    if error is not None:
+        logger.error("Background save failed for pattern %s: %s", pattern_id, error)
+    else:
+        logger.info("Pattern saved with ID: %s", pattern_id)
+
+def save_pattern_in_background(doc_ref, pattern_data: dict) -> None:
+    """Write a pattern document off the request path"""
+    future = firestore_executor.submit(doc_ref.set, pattern_data)
+    future.add_done_callback(lambda f: _log_background_save(f, doc_ref.id))
+
+def prepare_image_for_vision(image_data) -> str:
+    """Return base64 image content for Vision, downscaling oversized photos"""
+    # base64 inflates by 4/3, so small uploads are recognized without decoding
+    encoded_size = len(image_data) * 3 // 4 if isinstance(image_data, str) else len(image_data)
+    if encoded_size < VISION_RESIZE_MIN_BYTES:
+        if isinstance(image_data, bytes):
+            image_data = base64.b64encode(image_data).decode('ascii')
+        return image_data
+    
+    raw = base64.b64decode(image_data) if isinstance(image_data, str) else image_data
+    try:
+        with Image.open(io.BytesIO(raw)) as img:
+            if max(img.size) > VISION_MAX_DIMENSION:
+                # Let the JPEG decoder shrink by a power of two while decoding
+                scale = VISION_MAX_DIMENSION / max(img.size)
+                img.draft('RGB', (int(img.width * scale), int(img.height * scale)))
+                
+                # Re-encoding drops EXIF, so apply its rotation to the pixels first
+                img = ImageOps.exif_transpose(img)
+                if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+                    # JPEG has no alpha; flatten onto white so dark text on a
+                    # transparent background doesn't become black on black
+                    img = img.convert('RGBA')
+                    background = Image.new('RGB', img.size, 'white')
+                    background.paste(img, mask=img.getchannel('A'))
+                    img = background
+                img.thumbnail((VISION_MAX_DIMENSION, VISION_MAX_DIMENSION), Image.LANCZOS)
+                if img.mode not in ('RGB', 'L'):
+                    img = img.convert('RGB')
+                
+                buffer = io.BytesIO()
+                img.save(buffer, 'JPEG', quality=85, optimize=True)
+                logger.debug("Downscaled image for Vision: %s -> %s bytes", len(raw), buffer.tell())
+                raw = buffer.getvalue()
+    except (UnidentifiedImageError, OSError) as e:
+        # Let Vision judge formats Pillow can't read
+        logger.warning("Image preprocessing skipped: %s", e)
+    
+    return base64.b64encode(raw).decode('ascii')
+
+def is_pdf_upload(file_data, file_type: str) -> bool:
+    """Detect PDFs by declared type or by the %PDF magic bytes"""
+    if file_type == 'application/pdf':
+        return True
+    # Uploads are often labelled image/jpeg by default; 'JVBERi0' is
+    # base64 for '%PDF-', so sniffing needs no decode
+    if isinstance(file_data, str):
+        return file_data.startswith('JVBERi0')
+    return isinstance(file_data, bytes) and file_data.startswith(b'%PDF-')
+
+def find_image_list_error(file_data, file_type: str):
+    """Return why a multi-image imageData list can't be processed, if it can't"""
+    if not isinstance(file_data, list):
+        return None
+    if not file_data:
+        return 'imageData must not be an empty list'
+    for image in file_data:
+        if not isinstance(image, (str, bytes)):
+            return 'imageData list entries must be base64-encoded images'
+        # PDFs go through text extraction, which takes one document per request
+        if is_pdf_upload(image, file_type):
+            return 'PDFs must be uploaded one per request'
+    return None
+
+def extract_text_from_file(file_data, file_type: str) -> str:
+    """Route an upload to PDF or Vision extraction based on its file type"""
+    # Callers hand over their only reference to file_data, so rebinding it
+    # after decoding/encoding frees the original copy for the rest of the call
+    if is_pdf_upload(file_data, file_type):
+        if isinstance(file_data, str):
+            file_data = base64.b64decode(file_data)
+        return extract_text_from_pdf(file_data)
+    
+    if isinstance(file_data, list):
+        # Multi-page patterns scanned as one image per page
+        page_texts = extract_text_from_images([prepare_image_for_vision(image) for image in file_data])
+        return "".join(f"Page {page_num}:\n{text}\n\n"
+                       for page_num, text in enumerate(page_texts, 1)).strip()
+    
+    return extract_text_from_image(prepare_image_for_vision(file_data))
+
+def get_upload_request_data():
+    """Read request fields from a JSON body or a multipart/form-data upload"""
+    # Multipart uploads send the file as raw bytes in the 'file' part, skipping
+    # the ~33% base64 overhead; the bytes are exposed as 'imageData'
+    if request.mimetype == 'multipart/form-data':
+        data = request.form.to_dict()
+        uploads = request.files.getlist('file')
+        if uploads:
+            contents = [upload.read() for upload in uploads]
+            data['imageData'] = contents[0] if len(contents) == 1 else contents
+            data.setdefault('fileType', uploads[0].mimetype)
+        return data
+    
+    if request.is_json:
+        # cache=False keeps Flask from holding the raw body alongside the parsed copy
+        return request.get_json(cache=False)
+    
+    return None
+
 @app.route('/process-ocr', methods=['POST'])
 def process_ocr():
     """Process OCR request"""
     try:
-        if not request.is_json:
-            return jsonify({'error': 'Request must be JSON'}), 400
-        
-        data = request.get_json()
+        data = get_upload_request_data()
+        if data is None:
+            return jsonify({'error': 'Request must be JSON or multipart/form-data'}), 400
         
         # Validate required fields
         required_fields = ['imageData', 'patternName', 'authorName', 'userId']
@@ -108,19 +550,23 @@ def process_ocr():
             if field not in data:
                 return jsonify({'error': f'Missing required field: {field}'}), 400
         
-        image_data = data['imageData']
+        overlong_field = find_overlong_field(data, {'patternName': MAX_NAME_LENGTH, 'authorName': MAX_NAME_LENGTH})
+        if overlong_field:
+            return jsonify({'error': f'{overlong_field} must be at most {MAX_NAME_LENGTH} characters'}), 400
+        
         pattern_name = data['patternName']
         author_name = data['authorName']
         user_id = data['userId']
         file_type = data.get('fileType', 'image/jpeg')
         
-        logger.info(f"Processing {file_type} for pattern '{pattern_name}'")
+        image_list_error = find_image_list_error(data['imageData'], file_type)
+        if image_list_error:
+            return jsonify({'error': image_list_error}), 400
         
-        # Extract text based on file type
-        if file_type == 'application/pdf':
-            extracted_text = extract_text_from_pdf(image_data)
-        else:
-            extracted_text = extract_text_from_image(image_data)
+        logger.info("Processing %s for pattern '%s'", file_type, pattern_name)
+        
+        # Pop the payload so the parsed request body no longer references it
+        extracted_text = extract_text_from_file(data.pop('imageData'), file_type)
         
         # Save basic pattern to Firestore
         pattern_data = {
@@ -133,20 +579,33 @@ def process_ocr():
             'type': 'raw_ocr'
         }
         
-        doc_ref = db.collection('patterns').add(pattern_data)
-        pattern_id = doc_ref[1].id
+        # The document ID is generated client-side, so the response doesn't
+        # have to wait for the write to commit
+        doc_ref = get_db().collection('patterns').document()
+        pattern_id = doc_ref.id
         
-        logger.info(f"Pattern saved with ID: {pattern_id}")
+        # ?strict=true waits for the write so a failed save fails the request
+        if request.args.get('strict') == 'true':
+            doc_ref.set(pattern_data)
+            logger.info("Pattern saved with ID: %s", pattern_id)
+        else:
+            save_pattern_in_background(doc_ref, pattern_data)
+            logger.info("Pattern queued for save with ID: %s", pattern_id)
         
-        return jsonify({
+        response_data = {
             'success': True,
             'patternId': pattern_id,
             'extractedText': extracted_text,
             'message': f'Pattern "{pattern_name}" processed successfully'
-        })
+        }
+        # The text is saved with the pattern, so bulk callers can skip the echo
+        if request.args.get('include_text') == 'false':
+            del response_data['extractedText']
+        
+        return jsonify(response_data)
         
     except Exception as e:
-        logger.error(f"OCR processing failed: {str(e)}")
+        logger.error("OCR processing failed: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
@@ -165,11 +624,36 @@ def generate_pattern():
         for field in required_fields:
             if field not in data:
                 return jsonify({'error': f'Missing required field: {field}'}), 400
+            if not isinstance(data[field], str):
+                return jsonify({'error': f'Field must be a string: {field}'}), 400
+        
+        if find_overlong_field(data, {'patternText': MAX_PATTERN_TEXT_LENGTH}):
+            return jsonify({'error': f'patternText must be at most {MAX_PATTERN_TEXT_LENGTH} characters'}), 413
+        
+        overlong_field = find_overlong_field(data, {'patternName': MAX_NAME_LENGTH, 'authorName': MAX_NAME_LENGTH})
+        if overlong_field:
+            return jsonify({'error': f'{overlong_field} must be at most {MAX_NAME_LENGTH} characters'}), 400
         
         pattern_text = data['patternText']
         pattern_name = data['patternName']
         author_name = data['authorName']
         
+        # NDJSON clients get progress lines while Gemini is still generating
+        if request.accept_mimetypes.best == 'application/x-ndjson':
+            # The status is fixed at 200 once streaming starts, so reject
+            # unusable input here with the same status as the JSON path
+            if len(pattern_text) < MIN_PATTERN_TEXT_LENGTH:
+                logger.error("Pattern generation failed: %s", PATTERN_TEXT_TOO_SHORT_ERROR)
+                return jsonify({
+                    'success': False,
+                    'error': PATTERN_TEXT_TOO_SHORT_ERROR
+                }), 500
+            
+            return app.response_class(
+                stream_with_context(generate_pattern_ndjson(pattern_text, pattern_name, author_name)),
+                mimetype='application/x-ndjson'
+            )
+        
         # Generate pattern using Gemini AI
         pattern_json = generate_pattern_from_text(pattern_text, pattern_name, author_name)
         
@@ -180,103 +664,156 @@ def generate_pattern():
         })
         
     except Exception as e:
-        logger.error(f"Pattern generation failed: {str(e)}")
+        logger.error("Pattern generation failed: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
-def generate_pattern_from_text(pattern_text: str, pattern_name: str, author_name: str) -> dict:
-    """Generate pattern JSON using Gemini AI with comprehensive LogicGuide prompt"""
-    
-    # Validate input length to prevent API timeouts
-    if len(pattern_text) > 10000:
-        logger.warning(f"Pattern text is very long ({len(pattern_text)} chars), truncating to prevent API timeout")
-        pattern_text = pattern_text[:10000] + "... [truncated for processing]"
-    
-    if len(pattern_text) < 50:
-        raise Exception("Pattern text is too short. Please provide more detailed pattern instructions.")
+def generate_pattern_ndjson(pattern_text: str, pattern_name: str, author_name: str):
+    """Serialize generation events as newline-delimited JSON for streaming responses"""
+    try:
+        for event in generate_pattern_events(pattern_text, pattern_name, author_name):
+            if event['type'] == 'result':
+                event = {
+                    'type': 'result',
+                    'success': True,
+                    'patternData': event['patternData'],
+                    'message': f'Pattern "{pattern_name}" generated successfully'
+                }
+            yield orjson.dumps(event) + b'\n'
     
-    prompt = f"""You are an expert knitting pattern translator. Your task is to convert a condensed, human-readable knitting pattern into a fully enumerated, step-by-step JSON document following our precise Firestore schema.
-
-CORE PHILOSOPHY: Transform ambiguity into certainty. Eliminate all loops, repeats, and variables, producing a complete, explicit list of actions from cast on to bind off.
-
-TARGET SCHEMA:
-{{
-  "metadata": {{
-    "name": "{pattern_name}",
-    "author": "{author_name}", 
-    "craft": "knitting",
-    "maxSteps": 280
-  }},
-  "glossary": {{
-    "k": {{ "name": "Knit", "description": "A standard knit stitch.", "stitchesUsed": 1, "stitchesCreated": 1 }},
-    "kfb": {{ "name": "Knit Front and Back", "description": "A one-stitch increase.", "stitchesUsed": 1, "stitchesCreated": 2 }},
-    "k2tog": {{ "name": "Knit 2 Together", "description": "A one-stitch decrease.", "stitchesUsed": 2, "stitchesCreated": 1 }}
-  }},
-  "steps": [
-    {{
-      "step": 1,
-      "startingStitchCount": 3,
-      "endingStitchCount": 4,
-      "instruction": "k1, kfb, k1",
-      "section": "setup",
-      "side": "RS", 
-      "type": "regular"
-    }}
-  ]
-}}
-
-CRITICAL REQUIREMENTS:
-
-1. GLOSSARY CREATION: Build a complete glossary for EVERY stitch abbreviation used in the pattern. Each entry must have:
-   - name: Full name of the stitch
-   - description: Clear explanation of the technique
-   - stitchesUsed: How many stitches are consumed from left needle
-   - stitchesCreated: How many stitches are placed on right needle
-   
-   Net change = stitchesCreated - stitchesUsed
+    except Exception as e:
+        # Headers are already sent, so errors are reported in-stream
+        logger.error("Pattern generation failed: %s", e)
+        yield orjson.dumps({'type': 'error', 'success': False, 'error': str(e)}) + b'\n'
 
-2. STITCH COUNT CALCULATION: Every step MUST have accurate startingStitchCount and endingStitchCount. The endingStitchCount of one step becomes the startingStitchCount of the next.
+def _gemini_cache_key(prompt: str) -> str:
+    """Content hash of the full prompt; any prompt or input change is a new key"""
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
 
-3. EXPAND ALL REPEATS: 
-   - "Repeat Rows 3 and 4 five more times" → Generate 10 individual steps with consecutive numbering
-   - "(yo, ssk) 6 times" → "yo, ssk, yo, ssk, yo, ssk, yo, ssk, yo, ssk, yo, ssk"
-   - Recalculate variables like "k to end" for each expanded row
+def get_cached_gemini_response(prompt: str):
+    """Return a cached Gemini response for this exact prompt, or None"""
+    try:
+        snapshot = get_db().collection(GEMINI_CACHE_COLLECTION).document(_gemini_cache_key(prompt)).get()
+        if not snapshot.exists:
+            return None
+        
+        cached = snapshot.to_dict()
+        # Firestore's TTL policy deletes expired entries lazily, so check here too
+        expire_at = cached.get('expireAt')
+        if expire_at is None or datetime.now(timezone.utc) >= expire_at:
+            return None
+        
+        logger.debug("Gemini cache hit")
+        return cached.get('responseText')
+        
+    except Exception as e:
+        # The cache is an optimization; never fail a generation because of it
+        logger.warning("Gemini cache lookup failed: %s", e)
+        return None
 
-4. RESOLVE VARIABLES:
-   - "k to end" depends on current stitch count and preceding stitches in the row
-   - Example: Row with 10 stitches starting "k2, yo," then "k to end" = "k7" (10 - 2 knit - 1 yo stitch created)
-   - Always provide the fully resolved instruction
+def cache_gemini_response(prompt: str, response_text: str) -> None:
+    """Store a validated Gemini response keyed by prompt hash"""
+    try:
+        get_db().collection(GEMINI_CACHE_COLLECTION).document(_gemini_cache_key(prompt)).set({
+            'responseText': response_text,
+            'promptVersion': PROMPT_VERSION,
+            'createdAt': firestore.SERVER_TIMESTAMP,
+            # Firestore TTL policy field; see the README deployment steps
+            'expireAt': datetime.now(timezone.utc) + GEMINI_CACHE_TTL
+        })
+    except Exception as e:
+        logger.warning("Gemini cache write failed: %s", e)
 
-5. SEQUENTIAL PROCESSING:
-   - Initialize: currentStepNumber = 1, currentStitchCount from cast on
-   - For each row: calculate starting count, resolve variables, expand repeats, calculate ending count
-   - Update state: currentStitchCount = endingStitchCount, increment step number
-   - Alternate side: RS → WS → RS
+def iter_gemini_text(payload: dict):
+    """Call Gemini's streaming endpoint, yielding response text chunks as they arrive"""
+    # The concurrency slot is held until the stream has been fully read
+    with gemini_semaphore, http_session.post(
+        f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:streamGenerateContent?alt=sse&key={GEMINI_API_KEY}',
+        headers={'Content-Type': 'application/json'},
+        json=payload,
+        stream=True,
+        timeout=120  # Increased timeout for complex patterns
+    ) as response:
+        logger.debug("Gemini API response status: %s", response.status_code)
+        
+        if not response.ok:
+            error_detail = response.text
+            logger.error('Gemini API error %s: %s', response.status_code, error_detail)
+            raise Exception(f'Gemini API error: {response.status_code} - {error_detail}')
+        
+        received = 0
+        seen_brace = False
+        
+        # Each SSE event carries a partial GenerateContentResponse. Lines stay as
+        # bytes: text/event-stream has no charset, so requests would decode
+        # them as ISO-8859-1 and garble non-ASCII text; orjson reads UTF-8 bytes.
+        for line in response.iter_lines():
+            if not line or not line.startswith(b'data:'):
+                continue
+            
+            event = orjson.loads(line[len(b'data:'):])
+            parts = event.get('candidates', [{}])[0].get('content', {}).get('parts', [])
+            for part in parts:
+                text = part.get('text', '')
+                if not text:
+                    continue
+                received += len(text)
+                seen_brace = seen_brace or '{' in text
+                yield text
+            
+            # Stop paying for generation once the reply clearly isn't JSON
+            if not seen_brace and received > GEMINI_JSON_PREFIX_LIMIT:
+                logger.error('No JSON object in first %s characters of Gemini response', received)
+                raise Exception('Invalid JSON response format')
 
-PATTERN TO CONVERT:
-Name: {pattern_name}
-Author: {author_name}
+def parse_pattern_json(response_text: str) -> dict:
+    """Decode the pattern JSON from a Gemini reply"""
+    # JSON mode replies are a bare object, so try a direct parse first
+    try:
+        return orjson.loads(response_text)
+    except orjson.JSONDecodeError:
+        pass
+    
+    # Fallback for fenced or prose-wrapped replies (e.g. older cache entries):
+    # parse from the first brace; raw_decode stops at the end of that object
+    start_brace = response_text.find('{')
+    if start_brace == -1:
+        logger.error('No JSON braces found in response: %.200s...', response_text)
+        raise Exception('Invalid JSON response format')
+    
+    pattern_json, _ = JSON_OBJECT_DECODER.raw_decode(response_text, start_brace)
+    return pattern_json
 
-Pattern Text:
-{pattern_text}
+def build_generation_prompt(pattern_text: str, pattern_name: str, author_name: str) -> str:
+    """Append the per-pattern data to the cached LogicGuide prefix"""
+    return LOGIC_GUIDE_PROMPT + PATTERN_PROMPT_TEMPLATE.format(
+        pattern_name=pattern_name.strip(),
+        author_name=author_name.strip(),
+        pattern_text=pattern_text.strip()
+    )
 
-INSTRUCTIONS:
-1. First, identify the cast on instruction to establish initial stitch count
-2. Scan the entire pattern to build the complete glossary
-3. Process each row sequentially, expanding all repeats
-4. Calculate accurate stitch counts for every step
-5. Resolve all variable instructions to specific numbers
-6. Return ONLY the JSON object, no extra text or formatting
+def generate_pattern_from_text(pattern_text: str, pattern_name: str, author_name: str) -> dict:
+    """Generate pattern JSON using Gemini AI with comprehensive LogicGuide prompt"""
+    for event in generate_pattern_events(pattern_text, pattern_name, author_name):
+        if event['type'] == 'result':
+            return event['patternData']
 
-Return the complete JSON structure now:"""
+def generate_pattern_events(pattern_text: str, pattern_name: str, author_name: str):
+    """Generate a pattern, yielding progress events and finally a 'result' event"""
+    
+    # Validate input length to prevent API timeouts
+    if len(pattern_text) > 10000:
+        logger.warning("Pattern text is very long (%s chars), truncating to prevent API timeout", len(pattern_text))
+        pattern_text = pattern_text[:10000] + "... [truncated for processing]"
+    
+    if len(pattern_text) < MIN_PATTERN_TEXT_LENGTH:
+        raise Exception(PATTERN_TEXT_TOO_SHORT_ERROR)
+    
+    prompt = build_generation_prompt(pattern_text, pattern_name, author_name)
 
     # Call Gemini API
-    headers = {
-        'Content-Type': 'application/json',
-    }
-    
     payload = {
         'contents': [{
             'parts': [{ 'text': prompt }]
@@ -284,52 +821,36 @@ Return the complete JSON structure now:"""
         'generationConfig': {
             'temperature': 0.1,
             'maxOutputTokens': 8192,
-            'candidateCount': 1
+            'candidateCount': 1,
+            # JSON mode: Gemini returns a bare JSON object with no markdown fencing
+            'responseMimeType': 'application/json'
         }
     }
     
     try:
-        logger.info(f"Calling Gemini API for pattern: {pattern_name}")
-        logger.info(f"Pattern text length: {len(pattern_text)} characters")
-        
-        response = requests.post(
-            f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={GEMINI_API_KEY}',
-            headers=headers,
-            json=payload,
-            timeout=120  # Increased timeout for complex patterns
-        )
-        
-        logger.info(f"Gemini API response status: {response.status_code}")
-        
-        if not response.ok:
-            error_detail = response.text
-            logger.error(f'Gemini API error {response.status_code}: {error_detail}')
-            raise Exception(f'Gemini API error: {response.status_code} - {error_detail}')
-        
-        result = response.json()
-        response_text = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', '')
-        
-        if not response_text:
-            logger.error('Empty response from Gemini API')
-            raise Exception('No response from Gemini API')
-        
-        logger.info(f"Received response from Gemini, length: {len(response_text)} characters")
-        
-        # Clean and parse JSON response
-        clean_json = response_text.replace('```json', '').replace('```', '').strip()
-        
-        # Remove any leading/trailing non-JSON text
-        start_brace = clean_json.find('{')
-        end_brace = clean_json.rfind('}')
-        
-        if start_brace == -1 or end_brace == -1:
-            logger.error(f'No JSON braces found in response: {clean_json[:200]}...')
-            raise Exception('Invalid JSON response format')
+        logger.info("Calling Gemini API for pattern: %s", pattern_name)
+        logger.debug("Pattern text length: %s characters", len(pattern_text))
+        
+        response_text = get_cached_gemini_response(prompt)
+        cache_hit = response_text is not None
+        
+        if not cache_hit:
+            chunks = []
+            received = 0
+            for text in iter_gemini_text(payload):
+                chunks.append(text)
+                received += len(text)
+                yield {'type': 'progress', 'receivedChars': received}
+            
+            response_text = ''.join(chunks)
+            if not response_text:
+                logger.error('Empty response from Gemini API')
+                raise Exception('No response from Gemini API')
         
-        clean_json = clean_json[start_brace:end_brace+1]
+        logger.debug("Received response from Gemini, length: %s characters", len(response_text))
         
         try:
-            pattern_json = json.loads(clean_json)
+            pattern_json = parse_pattern_json(response_text)
             
             # Validate structure
             required_keys = ['metadata', 'glossary', 'steps']
@@ -347,45 +868,47 @@ Return the complete JSON structure now:"""
             steps_count = len(pattern_json['steps']) if isinstance(pattern_json['steps'], list) else 0
             pattern_json['metadata']['maxSteps'] = steps_count
             
-            logger.info(f"Successfully generated pattern with {steps_count} steps")
-            return pattern_json
+            # Only cache responses that parsed and validated cleanly
+            if not cache_hit:
+                cache_gemini_response(prompt, response_text)
+            
+            logger.info("Successfully generated pattern with %s steps", steps_count)
+            yield {'type': 'result', 'patternData': pattern_json}
             
         except json.JSONDecodeError as e:
-            logger.error(f'JSON Parse Error: {e}')
-            logger.error(f'Clean JSON attempt: {clean_json[:500]}...')
-            logger.error(f'Raw Response: {response_text[:500]}...')
+            logger.error('JSON Parse Error: %s', e)
+            logger.error('Raw Response: %.500s...', response_text)
             raise Exception(f'Failed to parse generated pattern: {e}')
             
     except requests.exceptions.Timeout:
         logger.error('Gemini API request timed out')
         raise Exception('Pattern generation timed out - pattern may be too complex')
     except requests.exceptions.RequestException as e:
-        logger.error(f'Request to Gemini API failed: {e}')
+        logger.error('Request to Gemini API failed: %s', e)
         raise Exception(f'Failed to connect to Gemini API: {e}')
     except Exception as e:
-        logger.error(f'Unexpected error in pattern generation: {e}')
+        logger.error('Unexpected error in pattern generation: %s', e)
         raise
 
 @app.route('/extract-text', methods=['POST'])
 def extract_text_only():
     """Extract text without saving pattern"""
     try:
-        if not request.is_json:
-            return jsonify({'error': 'Request must be JSON'}), 400
-        
-        data = request.get_json()
+        data = get_upload_request_data()
+        if data is None:
+            return jsonify({'error': 'Request must be JSON or multipart/form-data'}), 400
         
         if 'imageData' not in data:
             return jsonify({'error': 'Missing required field: imageData'}), 400
         
-        image_data = data['imageData']
         file_type = data.get('fileType', 'image/jpeg')
         
-        # Extract text based on file type
-        if file_type == 'application/pdf':
-            extracted_text = extract_text_from_pdf(image_data)
-        else:
-            extracted_text = extract_text_from_image(image_data)
+        image_list_error = find_image_list_error(data['imageData'], file_type)
+        if image_list_error:
+            return jsonify({'error': image_list_error}), 400
+        
+        # Pop the payload so the parsed request body no longer references it
+        extracted_text = extract_text_from_file(data.pop('imageData'), file_type)
         
         return jsonify({
             'success': True,
@@ -394,12 +917,51 @@ def extract_text_only():
         })
         
     except Exception as e:
-        logger.error(f"Text extraction failed: {str(e)}")
+        logger.error("Text extraction failed: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
+WARMUP_HOSTS = [
+    'https://vision.googleapis.com/',
+    'https://generativelanguage.googleapis.com/'
+]
+
+def warm_up_connections() -> dict:
+    """Open pooled TLS connections and the Firestore channel ahead of real traffic"""
+    timings = {}
+    for url in WARMUP_HOSTS:
+        started = time.monotonic()
+        try:
+            # Any response leaves a keep-alive connection in http_session's pool
+            http_session.head(url, timeout=5)
+        except requests.exceptions.RequestException as e:
+            logger.warning("Warmup request to %s failed: %s", url, e)
+        timings[url] = round((time.monotonic() - started) * 1000)
+    
+    started = time.monotonic()
+    try:
+        get_db().collection(GEMINI_CACHE_COLLECTION).document('_warmup').get()
+    except Exception as e:
+        logger.warning("Firestore warmup failed: %s", e)
+    timings['firestore'] = round((time.monotonic() - started) * 1000)
+    
+    return timings
+
+@app.route('/warmup', methods=['GET'])
+def warmup():
+    """Keep-warm target for Cloud Scheduler; refreshes pooled connections"""
+    return jsonify({
+        'status': 'warm',
+        'timingsMs': warm_up_connections()
+    })
+
+# Warm each worker as it boots without delaying gunicorn's readiness. PDF pool
+# children (spawned by multiprocessing) skip it; they only extract text.
+if multiprocessing.parent_process() is None:
+    threading.Thread(target=warm_up_connections, name='warmup', daemon=True).start()
+
 # Iterative Processing Endpoints - TEMPORARILY DISABLED
 # TODO: Re-enable after testing basic CORS functionality
 
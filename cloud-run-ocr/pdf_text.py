@@ -0,0 +1,89 @@
+"""
+PDF text extraction helpers for the OCR service's process pool.
+
+Kept separate from main.py so, under gunicorn, spawned worker processes only
+import the PDF libraries. When the service is run as `python main.py`, spawn
+also re-imports main.py in each child; main.py therefore creates its
+Firestore client lazily and skips connection warmup in pool children.
+"""
+
+import io
+import threading
+import pypdfium2 as pdfium
+import PyPDF2
+
+# PDFium is not thread-safe; serialize calls made from gunicorn's threads
+_pdfium_lock = threading.Lock()
+
+def count_pages(pdf_bytes: bytes) -> int:
+    """Return the number of pages in a PDF"""
+    try:
+        with _pdfium_lock:
+            pdf = pdfium.PdfDocument(pdf_bytes)
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
+    except pdfium.PdfiumError:
+        return len(PyPDF2.PdfReader(io.BytesIO(pdf_bytes)).pages)
+
+def extract_page_range(pdf_bytes: bytes, start: int, stop: int) -> list:
+    """Extract text for pages [start, stop) of a PDF, preferring PDFium"""
+    try:
+        with _pdfium_lock:
+            return _extract_with_pdfium(pdf_bytes, start, stop)
+    except pdfium.PdfiumError:
+        # PyPDF2 is slower but tolerates some files PDFium rejects
+        return _extract_with_pypdf2(pdf_bytes, start, stop)
+
+def render_page_range(pdf_bytes: bytes, start: int, stop: int, scale: float, max_dimension: int) -> list:
+    """Render pages [start, stop) of a PDF to JPEG bytes for OCR, capping the long edge"""
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_bytes)
+    try:
+        page_images = []
+        for page_num in range(start, stop):
+            # Lock per page, not per document, so other requests' PDF work
+            # can interleave with a long scan
+            with _pdfium_lock:
+                page = pdf[page_num]
+                # Large-format pages render straight to the cap instead of being
+                # rendered big and downscaled afterwards
+                page_scale = min(scale, max_dimension / max(page.get_size()))
+                bitmap = page.render(scale=page_scale)
+                try:
+                    image = bitmap.to_pil().copy()
+                finally:
+                    bitmap.close()
+                    page.close()
+            
+            # JPEG encoding is Pillow-only, so it runs outside the lock
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=85)
+            page_images.append(buffer.getvalue())
+        return page_images
+    finally:
+        with _pdfium_lock:
+            pdf.close()
+
+def _extract_with_pdfium(pdf_bytes: bytes, start: int, stop: int) -> list:
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    try:
+        page_texts = []
+        for page_num in range(start, stop):
+            page = pdf[page_num]
+            textpage = page.get_textpage()
+            try:
+                # PDFium emits CRLF line breaks; match PyPDF2's LF output
+                page_texts.append(textpage.get_text_range().replace('\r\n', '\n'))
+            finally:
+                # Free native buffers promptly rather than waiting for GC
+                textpage.close()
+                page.close()
+        return page_texts
+    finally:
+        pdf.close()
+
+def _extract_with_pypdf2(pdf_bytes: bytes, start: int, stop: int) -> list:
+    pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+    return [pdf_reader.pages[page_num].extract_text() for page_num in range(start, stop)]